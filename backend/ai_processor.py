@@ -1,75 +1,163 @@
 import os
-import json
+import asyncio
+import datetime
+import functools
+import hashlib
+import logging
+import re
+import time
+import weakref
+from string import Template
 import google.generativeai as genai
+from google.generativeai import caching, client as genai_client
+from google.api_core import exceptions as google_exceptions
+import orjson
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from typing import Dict, Any
+from typing import Callable, Dict, Any, Optional
 
 from models import FormattingOptions
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # --- Gemini API Configuration ---
+MODEL_NAME = 'gemini-2.5-flash'
+
 try:
     api_key = os.environ.get("GOOGLE_API_KEY")
     if not api_key:
         raise ValueError("GOOGLE_API_KEY not found.")
     genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-2.5-flash')
 except Exception as e:
     raise RuntimeError(f"Failed to configure Gemini API: {e}")
 
+@functools.cache
+def get_model() -> genai.GenerativeModel:
+    """Returns the process-wide Gemini model, constructing it on first use."""
+    try:
+        return genai.GenerativeModel(MODEL_NAME)
+    except Exception as e:
+        raise RuntimeError(f"Failed to configure Gemini API: {e}")
 
-async def detect_languages_in_text(raw_text: str) -> list[str]:
-    """Uses the AI to detect the primary languages present in a text."""
-    sample_text = (raw_text[:2000] + '...') if len(raw_text) > 2000 else raw_text
-    prompt = f"""
+def open_client() -> None:
+    """
+    Builds the SDK's shared async client up front, on the server's event
+    loop, so the first request doesn't pay for channel setup. Every model
+    picks up this client, so all calls share its pooled connection.
+    """
+    genai_client.get_default_generative_async_client()
+    get_model()
+
+def reset_default_async_client() -> None:
+    """
+    Forgets the SDK's default async client so the next use builds a new one.
+    The SDK offers no public way to do this, so a private registry is edited;
+    if a newer SDK moves it, a warning is logged instead of failing shutdown.
+    """
+    try:
+        genai_client._client_manager.clients.pop("generative_async", None)
+    except (AttributeError, TypeError):
+        logger.warning("Could not reset the Gemini SDK's default async client", exc_info=True)
+
+async def close_client() -> None:
+    """
+    Closes the shared async client's channel and drops every model holding it,
+    along with this loop's request semaphore, so a later open_client() starts
+    from a fresh client.
+    """
+    async_client = genai_client.get_default_generative_async_client()
+    await async_client.transport.close()
+    reset_default_async_client()
+    get_model.cache_clear()
+    context_cache_models.clear()
+    gemini_semaphores.pop(asyncio.get_running_loop(), None)
+
+# --- Manuscript Chunking ---
+# Large manuscripts are edited in paragraph-aligned chunks so the editor
+# pass can run as several concurrent requests instead of one long one.
+# A paragraph too long for one chunk is cut after a sentence instead
+# (Latin punctuation or a Devanagari danda, plus any closing quotes).
+CHUNK_SIZE = 6000
+MAX_PARALLEL_CHUNKS = int(os.environ.get("GEMINI_MAX_PARALLEL_CHUNKS", "8"))
+SENTENCE_BREAK = re.compile(r'[.?!\u0964\u0965]["\'\u201d\u2019)]*([ \t]+)')
+
+# --- Request Concurrency ---
+# Caps in-flight Gemini requests across all endpoints and manuscripts in this
+# process, on top of the per-manuscript chunk limit, to stay inside quota.
+# A semaphore binds to the event loop that first waits on it, so there is one
+# per loop; a restarted lifespan or a second asyncio.run gets a fresh one.
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("LLM_CONCURRENCY", "10"))
+gemini_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+def gemini_semaphore() -> asyncio.Semaphore:
+    """Returns the request semaphore for the running event loop."""
+    loop = asyncio.get_running_loop()
+    semaphore = gemini_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = gemini_semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return semaphore
+
+# --- Retries ---
+# Transient Gemini failures (rate limits, overload, timeouts) are retried
+# with exponential backoff, so one flaky call doesn't fail a whole book.
+MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY_SECONDS = 1.0
+RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+)
+
+# --- Gemini Context Caching ---
+# Opt-in: when a TTL is configured, each large manuscript chunk is uploaded
+# once as cached content, and repeat editor passes over the same chunk (e.g.
+# re-finalizing with different formatting options) reference it instead of
+# resending the text.
+CONTEXT_CACHE_TTL_MINUTES = int(os.environ.get("GEMINI_CONTEXT_CACHE_TTL_MINUTES", "0"))
+# Gemini rejects cached content below a minimum size (1024 tokens for 2.5 Flash).
+CONTEXT_CACHE_MIN_TOKENS = 1024
+# A text that can't be cached (too few tokens, or creation failed) is remembered
+# for a while, so later passes over it go straight to the plain model.
+CONTEXT_CACHE_RETRY_SECONDS = 10 * 60
+CACHED_MANUSCRIPT_REFERENCE = "(The manuscript to process is provided in the cached context.)"
+context_cache_models: Dict[bytes, tuple] = {}
+
+# --- Response Cache ---
+# Response text keyed by a digest of (model, cached context, prompt), so an
+# identical request (e.g. re-finalizing an unchanged manuscript) is answered
+# without a round trip. Entries expire after an hour so a long-running
+# server doesn't hold stale edits forever. Only touched from the event
+# loop, so no lock is needed.
+RESPONSE_CACHE_SIZE = 512
+RESPONSE_CACHE_TTL_SECONDS = 60 * 60
+response_cache: "TTLCache[bytes, str]" = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL_SECONDS)
+
+# --- Prompt Templates ---
+# Compiled once at import; only the per-request slots are substituted.
+LANGUAGE_DETECTION_TEMPLATE = Template("""
     Analyze the following text and identify all significant languages present.
     Your response must be a valid JSON array of strings.
     For example: ["English", "Hindi", "Sanskrit"]
 
     Text to analyze:
     ---
-    {sample_text}
+    $sample_text
     ---
 
     JSON Array:
-    """
-    try:
-        response = await model.generate_content_async(prompt)
-        json_text = response.text.strip().replace("```json", "").replace("```", "")
-        detected_languages = json.loads(json_text)
-        return detected_languages
-    except Exception as e:
-        print(f"Error during language detection: {e}")
-        return ["English"]
-
+    """)
 
-def generate_final_editor_prompt(raw_text: str, tone: str, options: FormattingOptions) -> str:
-    """
-    Generates the master prompt for the final editorial pass with strict rules
-    to preserve the original content.
-    """
-    sanskrit_rules = ""
-    if options.sanskrit_shlokas:
-        opts = options.sanskrit_shlokas
-        sanskrit_rules += "\n    **Sanskrit Shloka Formatting Rules:**\n"
-        sanskrit_rules += "    - Preserve the original Devanagari script perfectly.\n"
-        sanskrit_rules += "    - Maintain correct Sandhi and Samas (do not break joined words inappropriately).\n"
-        if opts.line_breaks:
-            sanskrit_rules += "    - Inside the [SHLOKA]...[/SHLOKA] tags, insert a newline character '\\n' to separate each half-verse (pāda).\n"
-        if opts.add_numbering:
-            sanskrit_rules += "    - If you can identify the source (e.g., Bhagavad Gita), add a citation marker like [CITE: Bhagavad Gita 2.47] immediately after the shloka.\n"
-        if opts.translation_style != "No translation":
-             sanskrit_rules += f"    - After the shloka, add the English translation. The style should be: '{opts.translation_style}'. Prefix the translation with the label 'Translation: '. Embed this entire block (label and text) inside a [TRANSLATION]...[/TRANSLATION] tag.\n"
-    
-    return f"""
+EDITOR_HEADER_TEMPLATE = Template("""
     You are a technical typesetter and proofreader with deep expertise in English, Hindi, and Sanskrit.
 
     **PRIMARY RULE: DO NOT CHANGE THE AUTHOR'S ORIGINAL WORDS OR SENTENCE STRUCTURE.**
     - Your only job is to fix surface-level errors and apply the formatting markers specified below.
     - **DO NOT** rewrite, rephrase, or restructure any sentences.
     - **DO NOT** add any content, ideas, or explanations. The original text must be preserved exactly as written by the author.
-    - The tone '{tone}' is for context only; do not change words to match it.
+    - The tone '$tone' is for context only; do not change words to match it.
 
     **PROOFREADER'S CHECKLIST (Surface-level fixes ONLY):**
     1.  **Correct Errors:** Fix obvious spelling mistakes, grammatical errors (like subject-verb agreement), punctuation, and typos.
@@ -77,7 +165,7 @@ def generate_final_editor_prompt(raw_text: str, tone: str, options: FormattingOp
     3.  **Capitalization:** Ensure proper capitalization at the start of sentences and for proper nouns.
 
     **SPECIFIC FORMATTING RULES:**
-    {sanskrit_rules if sanskrit_rules else "    - No special language formatting requested."}
+    $sanskrit_rules
 
     **OUTPUT MARKER INSTRUCTIONS (MANDATORY):**
     You MUST use the following markers to structure your output. Do not use any markdown.
@@ -88,15 +176,15 @@ def generate_final_editor_prompt(raw_text: str, tone: str, options: FormattingOp
 
     **MANUSCRIPT TO PROCESS:**
     ---
-    {raw_text}
+    """)
+
+EDITOR_FOOTER = """
     ---
 
     Return only the corrected and formatted manuscript text, adhering strictly to all rules.
     """
 
-def generate_glossary_prompt(edited_text: str) -> str:
-    """Generates a prompt to extract a glossary."""
-    return f"""
+GLOSSARY_TEMPLATE = Template("""
     You are a linguistic analyst. Analyze the following manuscript to produce a glossary of all non-English terms.
     Your output MUST be a valid JSON array of objects. Each object must have four keys: "term", "transliteration", "translation", and "context".
 
@@ -111,35 +199,252 @@ def generate_glossary_prompt(edited_text: str) -> str:
 
     **EDITED MANUSCRIPT:**
     ---
-    {edited_text}
+    $edited_text
     ---
 
     JSON Output:
+    """)
+
+
+def parse_json_response(response_text: str, opener: str = '[', closer: str = ']'):
+    """
+    Parses the JSON payload out of a model response, ignoring any markdown
+    fences or chatter around the outermost `opener`...`closer` pair.
     """
+    start = response_text.find(opener)
+    end = response_text.rfind(closer) + 1
+    if start == -1 or end <= start:
+        raise ValueError("No JSON payload found in the AI response.")
+    return orjson.loads(response_text[start:end])
 
-async def finalize_manuscript(raw_text: str, tone: str, options: FormattingOptions, generate_glossary: bool) -> Dict[str, Any]:
-    """Orchestrates the two-stage AI processing pipeline for the final edit."""
-    editor_prompt = generate_final_editor_prompt(raw_text, tone, options)
+def parse_language_list(response_text: str) -> list[str]:
+    """Parses the language detection reply, which must be a JSON array of strings."""
+    languages = parse_json_response(response_text)
+    if not isinstance(languages, list) or not all(isinstance(language, str) for language in languages):
+        raise ValueError("Language detection did not return a list of strings.")
+    return languages
+
+async def get_context_cached_model(text: str) -> Optional[genai.GenerativeModel]:
+    """
+    Returns a model whose context already holds `text` as Gemini cached content,
+    creating the cache on first use. Returns None when context caching is
+    disabled, the text is below the token minimum, or creation fails; the
+    last two outcomes are remembered for CONTEXT_CACHE_RETRY_SECONDS.
+    """
+    # A token covers at least one character, so a shorter text can't reach the minimum.
+    if not CONTEXT_CACHE_TTL_MINUTES or len(text) < CONTEXT_CACHE_MIN_TOKENS:
+        return None
+
+    now = time.monotonic()
+    for expired_key in [key for key, (_, expires_at) in context_cache_models.items() if expires_at <= now]:
+        del context_cache_models[expired_key]
+
+    cache_key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    if cache_key in context_cache_models:
+        return context_cache_models[cache_key][0]
+
+    ttl = datetime.timedelta(minutes=CONTEXT_CACHE_TTL_MINUTES)
     try:
-        edited_response = await model.generate_content_async(editor_prompt)
-        edited_manuscript = edited_response.text
-    except Exception as e:
-        print(f"Error during Stage 1 (Editor Pass): {e}")
-        raise RuntimeError("AI failed during the main editing phase.")
+        async with gemini_semaphore():
+            token_count = await get_model().count_tokens_async(text)
+        if token_count.total_tokens < CONTEXT_CACHE_MIN_TOKENS:
+            context_cache_models[cache_key] = (None, now + CONTEXT_CACHE_RETRY_SECONDS)
+            return None
+        async with gemini_semaphore():
+            cached_content = await asyncio.to_thread(
+                caching.CachedContent.create, model=f"models/{MODEL_NAME}", contents=[text], ttl=ttl
+            )
+    except Exception:
+        logger.warning("Could not create a Gemini context cache, sending the text inline", exc_info=True)
+        context_cache_models[cache_key] = (None, now + CONTEXT_CACHE_RETRY_SECONDS)
+        return None
+    cached_model = genai.GenerativeModel.from_cached_content(cached_content)
+    # Drop our handle before the server-side cache expires.
+    context_cache_models[cache_key] = (cached_model, now + ttl.total_seconds() * 0.9)
+    return cached_model
+
+async def generate_text(prompt: str, model: Optional[genai.GenerativeModel] = None, parse: Optional[Callable[[str], Any]] = None) -> Any:
+    """
+    Sends a prompt to Gemini and returns the response text.
+    Every AI call goes through here so they all share the one model and the
+    SDK's single async client, whose gRPC channel multiplexes concurrent
+    requests over one pooled connection. `model` can be a context-cached
+    model from get_context_cached_model().
+    With `parse`, returns parse(text) instead. The response is only cached
+    once it parses, so a malformed reply is requested again next time rather
+    than replayed for the cache's lifetime.
+    """
+    model = model or get_model()
+    key_hash = hashlib.blake2b(f"{model.model_name}\0{model.cached_content or ''}\0".encode('utf-8'), digest_size=16)
+    key_hash.update(prompt.encode('utf-8'))
+    cache_key = key_hash.digest()
+    cached_text = response_cache.get(cache_key)
+    if cached_text is not None:
+        return parse(cached_text) if parse else cached_text
 
-    glossary_data = []
-    if generate_glossary:
-        glossary_prompt = generate_glossary_prompt(edited_manuscript)
+    for attempt in range(MAX_ATTEMPTS):
         try:
-            glossary_response = await model.generate_content_async(glossary_prompt)
-            json_text = glossary_response.text.strip().replace("```json", "").replace("```", "")
-            glossary_data = json.loads(json_text)
+            async with gemini_semaphore():
+                response = await model.generate_content_async(prompt)
+            text = response.text
+            break
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            delay = RETRY_BASE_DELAY_SECONDS * 2 ** attempt
+            logger.warning("Gemini request failed (%s), retrying in %.0fs", e, delay)
+            await asyncio.sleep(delay)
+
+    result = parse(text) if parse else text
+    response_cache[cache_key] = text
+    return result
+
+
+async def detect_languages_in_text(raw_text: str) -> list[str]:
+    """Uses the AI to detect the primary languages present in a text."""
+    if not raw_text.strip():
+        return []
+    sample_text = (raw_text[:2000] + '...') if len(raw_text) > 2000 else raw_text
+    prompt = LANGUAGE_DETECTION_TEMPLATE.substitute(sample_text=sample_text)
+    try:
+        # Repeat analyses of the same manuscript are answered from the response cache.
+        return await generate_text(prompt, parse=parse_language_list)
+    except Exception:
+        logger.exception("Error during language detection")
+        return ["English"]
+
+
+@functools.lru_cache(maxsize=32)
+def sanskrit_rules_block(line_breaks: bool, add_numbering: bool, translation_style: str) -> str:
+    """Builds the Sanskrit shloka section of the editor prompt for one combination of options."""
+    rules = [
+        "\n    **Sanskrit Shloka Formatting Rules:**\n",
+        "    - Preserve the original Devanagari script perfectly.\n",
+        "    - Maintain correct Sandhi and Samas (do not break joined words inappropriately).\n",
+    ]
+    if line_breaks:
+        rules.append("    - Inside the [SHLOKA]...[/SHLOKA] tags, insert a newline character '\\n' to separate each half-verse (pāda).\n")
+    if add_numbering:
+        rules.append("    - If you can identify the source (e.g., Bhagavad Gita), add a citation marker like [CITE: Bhagavad Gita 2.47] immediately after the shloka.\n")
+    if translation_style != "No translation":
+        rules.append(f"    - After the shloka, add the English translation. The style should be: '{translation_style}'. Prefix the translation with the label 'Translation: '. Embed this entire block (label and text) inside a [TRANSLATION]...[/TRANSLATION] tag.\n")
+    return "".join(rules)
+
+@functools.lru_cache(maxsize=64)
+def editor_prompt_header(tone: str, sanskrit_rules: str) -> str:
+    """Renders the instruction part of the editor prompt, which only depends on tone and rules."""
+    return EDITOR_HEADER_TEMPLATE.substitute(tone=tone, sanskrit_rules=sanskrit_rules)
+
+def generate_final_editor_prompt(raw_text: str, tone: str, options: FormattingOptions) -> str:
+    """
+    Generates the master prompt for the final editorial pass with strict rules
+    to preserve the original content.
+    """
+    sanskrit_rules = "    - No special language formatting requested."
+    if options.sanskrit_shlokas:
+        opts = options.sanskrit_shlokas
+        sanskrit_rules = sanskrit_rules_block(opts.line_breaks, opts.add_numbering, opts.translation_style)
+
+    return editor_prompt_header(tone, sanskrit_rules) + raw_text + EDITOR_FOOTER
+
+def generate_glossary_prompt(edited_text: str) -> str:
+    """Generates a prompt to extract a glossary."""
+    return GLOSSARY_TEMPLATE.substitute(edited_text=edited_text)
+
+def split_into_chunks(raw_text: str, max_chars: int = CHUNK_SIZE) -> list[tuple[str, str]]:
+    """
+    Cuts the text into chunks of at most `max_chars` characters, breaking at
+    paragraph boundaries, or at sentence boundaries inside a paragraph that
+    is too long on its own. Returns (chunk, separator) pairs, where the
+    separator is the text removed at the cut, so the chunks can be rejoined.
+    Cut points are located with str.rfind and a bounded regex search so the
+    manuscript is never materialized as a list of lines.
+    """
+    chunks = []
+    start = 0
+    while len(raw_text) - start > max_chars:
+        end = start + max_chars + 1
+        cut = raw_text.rfind('\n', start + 1, end)
+        if cut == -1:
+            sentence_break = None
+            for sentence_break in SENTENCE_BREAK.finditer(raw_text, start + 1, end):
+                pass
+            if sentence_break:
+                chunks.append((raw_text[start:sentence_break.start(1)], sentence_break.group(1)))
+                start = sentence_break.end()
+                continue
+            # A single sentence longer than max_chars runs on to the paragraph's end.
+            cut = raw_text.find('\n', start + max_chars)
+            if cut == -1:
+                break
+        chunks.append((raw_text[start:cut], '\n'))
+        start = cut + 1
+    chunks.append((raw_text[start:], ''))
+    return chunks
+
+def merge_glossaries(chunk_glossaries: list[list[dict]]) -> list[dict]:
+    """
+    Merges per-chunk glossaries into one list with a single entry per term,
+    in order of first appearance. Missing fields are filled from later entries.
+    """
+    merged: Dict[str, dict] = {}
+    for chunk_glossary in chunk_glossaries:
+        for item in chunk_glossary:
+            if not isinstance(item, dict):
+                continue
+            term = (item.get("term") or "").strip()
+            existing = merged.get(term)
+            if existing is None:
+                merged[term] = dict(item)
+                continue
+            for key in ("transliteration", "translation", "context"):
+                if not existing.get(key) and item.get(key):
+                    existing[key] = item[key]
+    return list(merged.values())
+
+async def finalize_manuscript(raw_text: str, tone: str, options: FormattingOptions, generate_glossary: bool) -> Dict[str, Any]:
+    """
+    Orchestrates the two-stage AI processing pipeline for the final edit.
+    Each chunk's glossary pass starts as soon as that chunk has been edited,
+    overlapping Stage 2 with the editing of later chunks; the per-chunk
+    glossaries are then merged into one deduplicated list.
+    """
+    if not raw_text.strip():
+        return {"edited_manuscript": raw_text, "glossary": []}
+
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_CHUNKS)
+
+    async def process_chunk(chunk: str):
+        async with semaphore:
+            cached_model = await get_context_cached_model(chunk)
+            manuscript = CACHED_MANUSCRIPT_REFERENCE if cached_model else chunk
+            edited_chunk = await generate_text(generate_final_editor_prompt(manuscript, tone, options), model=cached_model)
+        if not generate_glossary:
+            return edited_chunk, []
+        try:
+            async with semaphore:
+                chunk_glossary = await generate_text(generate_glossary_prompt(edited_chunk), parse=parse_json_response)
+            return edited_chunk, chunk_glossary
         except Exception as e:
-            print(f"Error during Stage 2 (Glossary Pass): {e}")
-            glossary_data = [{"term": "Error", "transliteration": "Processing Failed", "translation": f"Could not generate glossary: {e}", "context": ""}]
+            return edited_chunk, e
+
+    chunks = split_into_chunks(raw_text)
+    results = await asyncio.gather(*(process_chunk(chunk) for chunk, _ in chunks), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Error during Stage 1 (Editor Pass)", exc_info=result)
+            raise RuntimeError("AI failed during the main editing phase.")
+    edited_manuscript = ''.join(edited_chunk + separator for (edited_chunk, _), (_, separator) in zip(results, chunks))
+
+    chunk_glossaries = [chunk_glossary for _, chunk_glossary in results if not isinstance(chunk_glossary, Exception)]
+    glossary_errors = [chunk_glossary for _, chunk_glossary in results if isinstance(chunk_glossary, Exception)]
+    glossary_data = merge_glossaries(chunk_glossaries)
+    if glossary_errors:
+        glossary_error = glossary_errors[0]
+        logger.error("Error during Stage 2 (Glossary Pass)", exc_info=glossary_error)
+        glossary_data.append({"term": "Error", "transliteration": "Processing Failed", "translation": f"Could not generate glossary: {glossary_error}", "context": ""})
 
     return {
         "edited_manuscript": edited_manuscript,
         "glossary": glossary_data
     }
-
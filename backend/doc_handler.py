@@ -1,19 +1,177 @@
+import copy
 import io
 import re
+from typing import IO
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 from docx import Document
 from docx.shared import Pt, Inches
-from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+from docx.oxml.ns import qn
+from docx.opc.pkgwriter import PackageWriter
+from lxml import etree
 
 from models import FinalDocumentData
 
-def extract_text_from_docx(docx_file_stream: io.BytesIO) -> str:
-    """Reads a .docx file and returns its raw text."""
+MARKER_TAGS = frozenset({'H1', 'H2', 'SHLOKA', 'TRANSLATION'})
+MAX_TAG_LENGTH = max(len(tag) for tag in MARKER_TAGS)
+RUN_CONTROL_CHARS = re.compile(r'([\t\n\r])')
+STRAY_MARKERS = re.compile(r'\[/?(ITALIC|CITE:.*?)\]')
+
+# Text extraction reads the main document part straight from the archive.
+# The parser matches python-docx's and never resolves entities in uploads.
+PACKAGE_RELS_PATH = '_rels/.rels'
+OFFICE_DOCUMENT_REL_TYPE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument'
+XML_PARSER = etree.XMLParser(remove_blank_text=True, resolve_entities=False)
+
+# Run content of a paragraph, including runs nested in hyperlinks, in document order.
+RUN_CONTENT_XPATH = etree.XPath(
+    './w:r/* | ./w:hyperlink/w:r/*',
+    namespaces={'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'},
+)
+W_P, W_T, W_BR = qn('w:p'), qn('w:t'), qn('w:br')
+W_DOCUMENT, W_BODY = qn('w:document'), qn('w:body')
+RUN_CONTENT_TEXT = {qn('w:tab'): '\t', qn('w:ptab'): '\t', qn('w:cr'): '\n', qn('w:noBreakHyphen'): '-'}
+
+def paragraph_text(p) -> str:
+    """Returns the text of a <w:p> element the same way python-docx's Paragraph.text does."""
+    parts = []
+    for e in RUN_CONTENT_XPATH(p):
+        if e.tag == W_T:
+            parts.append(e.text or '')
+        elif e.tag == W_BR:
+            if e.get(qn('w:type'), 'textWrapping') == 'textWrapping':
+                parts.append('\n')
+        else:
+            parts.append(RUN_CONTENT_TEXT.get(e.tag, ''))
+    return ''.join(parts)
+
+def main_document_path(docx_zip: ZipFile) -> str:
+    """Returns the archive path of the main document part, as named in the package relationships."""
+    package_rels = etree.fromstring(docx_zip.read(PACKAGE_RELS_PATH), XML_PARSER)
+    for rel in package_rels:
+        if rel.get('Type') == OFFICE_DOCUMENT_REL_TYPE:
+            return rel.get('Target').lstrip('/')
+    raise ValueError("the package has no main document part")
+
+def extract_text_from_docx(docx_file_stream: IO[bytes]) -> str:
+    """
+    Reads a .docx file and returns its raw text. The main document XML is
+    parsed straight out of the archive, skipping python-docx's package
+    loading and proxy objects; the text matches Document.paragraphs.
+    """
     try:
-        document = Document(docx_file_stream)
-        return '\n'.join([para.text for para in document.paragraphs])
+        with ZipFile(docx_file_stream) as docx_zip:
+            document = etree.fromstring(docx_zip.read(main_document_path(docx_zip)), XML_PARSER)
+        body = document.find(W_BODY)
+        if document.tag != W_DOCUMENT or body is None:
+            raise ValueError("file is not a Word document")
+        return '\n'.join(paragraph_text(p) for p in body.iterchildren(W_P))
     except Exception as e:
         raise ValueError(f"Could not read the docx file: {e}")
 
+def iter_segments(text: str):
+    """
+    Splits marked-up manuscript text into (tag, start, end) spans in a single pass.
+    Plain text between markers is yielded with a tag of None. Spans are offsets
+    into `text`, so no substrings are created while scanning.
+    """
+    cursor = 0
+    search_from = 0
+    while True:
+        open_start = text.find('[', search_from)
+        if open_start == -1:
+            break
+        open_end = text.find(']', open_start + 1, open_start + MAX_TAG_LENGTH + 2)
+        tag = text[open_start + 1:open_end] if open_end != -1 else None
+        if tag not in MARKER_TAGS:
+            search_from = open_start + 1
+            continue
+        closer = f'[/{tag}]'
+        close_start = text.find(closer, open_end + 1)
+        if close_start == -1:
+            search_from = open_start + 1
+            continue
+
+        yield None, cursor, open_start
+        yield tag, open_end + 1, close_start
+        cursor = search_from = close_start + len(closer)
+
+    yield None, cursor, len(text)
+
+def strip_span(text: str, start: int, end: int) -> tuple[int, int]:
+    """Narrows the span text[start:end] the way str.strip() would, without slicing."""
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+def insert_paragraph(anchor, alignment: str = None):
+    """Creates a bare <w:p> element directly before `anchor` (the body's sectPr)."""
+    p = etree.Element(qn('w:p'))
+    if alignment:
+        p_pr = etree.SubElement(p, qn('w:pPr'))
+        etree.SubElement(p_pr, qn('w:jc')).set(qn('w:val'), alignment)
+    anchor.addprevious(p)
+    return p
+
+def append_run(p, text: str, font_size: int = None, bold: bool = None, italic: bool = False):
+    """
+    Appends a <w:r> to paragraph element `p`, mirroring python-docx's add_run():
+    tabs become <w:tab/> and line breaks become <w:br/>.
+    """
+    r = etree.SubElement(p, qn('w:r'))
+    if bold is not None or italic or font_size:
+        r_pr = etree.SubElement(r, qn('w:rPr'))
+        if bold is not None:
+            b = etree.SubElement(r_pr, qn('w:b'))
+            if not bold:
+                b.set(qn('w:val'), '0')
+        if italic:
+            etree.SubElement(r_pr, qn('w:i'))
+        if font_size:
+            etree.SubElement(r_pr, qn('w:sz')).set(qn('w:val'), str(font_size * 2))
+    for piece in RUN_CONTROL_CHARS.split(text):
+        if piece == '\t':
+            etree.SubElement(r, qn('w:tab'))
+        elif piece in ('\n', '\r'):
+            etree.SubElement(r, qn('w:br'))
+        elif piece:
+            t = etree.SubElement(r, qn('w:t'))
+            t.text = piece
+            if len(piece.strip()) < len(piece):
+                t.set(qn('xml:space'), 'preserve')
+    return r
+
+class ZipPackageWriter:
+    """
+    Drop-in for python-docx's internal zip writer that lets the caller pick the
+    compression. python-docx always uses DEFLATE at the default level, which
+    dominates save time for text-heavy documents.
+    """
+    def __init__(self, pkg_file, compress: bool = True):
+        if compress:
+            self._zipf = ZipFile(pkg_file, 'w', compression=ZIP_DEFLATED, compresslevel=1)
+        else:
+            self._zipf = ZipFile(pkg_file, 'w', compression=ZIP_STORED)
+
+    def write(self, pack_uri, blob):
+        self._zipf.writestr(pack_uri.membername, blob)
+
+    def close(self):
+        self._zipf.close()
+
+def save_document(document, file_stream, compress: bool = True):
+    """Equivalent of document.save(file_stream) using ZipPackageWriter."""
+    package = document.part.package
+    parts = package.parts
+    for part in parts:
+        part.before_marshal()
+    writer = ZipPackageWriter(file_stream, compress)
+    PackageWriter._write_content_types_stream(writer, parts)
+    PackageWriter._write_pkg_rels(writer, package.rels)
+    PackageWriter._write_parts(writer, parts)
+    writer.close()
+
 def create_final_docx(params: FinalDocumentData) -> io.BytesIO:
     """Creates the final, formatted .docx file from the edited text and glossary."""
     document = Document()
@@ -35,47 +193,49 @@ def create_final_docx(params: FinalDocumentData) -> io.BytesIO:
         section.right_margin = Inches(params.margin_right)
 
     # --- 2. Parse and Add Manuscript Content ---
-    content_without_markers = params.edited_manuscript
-    pattern = re.compile(r'(\[(H1|H2|SHLOKA|TRANSLATION)\].*?\[/\2\])', re.DOTALL)
-    
-    cursor = 0
-    for match in pattern.finditer(content_without_markers):
-        plain_text = content_without_markers[cursor:match.start()]
-        if plain_text.strip():
-            document.add_paragraph(plain_text.strip())
-
-        tag = match.group(2)
-        content = match.group(1)[len(tag)+2:-len(tag)-3].strip()
-
-        if tag == 'H1':
-            p = document.add_paragraph()
-            run = p.add_run(content)
-            run.font.size = Pt(params.heading1.font_size)
-            run.bold = params.heading1.bold
+    # Paragraphs are written straight into the body XML rather than through
+    # python-docx's Paragraph/Run wrappers, which are slow for long manuscripts.
+    sect_pr = document.element.body.sectPr
+    text = params.edited_manuscript
+    for tag, start, end in iter_segments(text):
+        if tag is None and end == len(text):
+            # Stray inline markers are cleaned from the trailing text only.
+            remaining_text = text[start:end]
+            if remaining_text.strip():
+                p = insert_paragraph(sect_pr)
+                content = STRAY_MARKERS.sub('', remaining_text).strip()
+                if content:
+                    append_run(p, content)
+            continue
+
+        # Substrings are only sliced out at the point they're written to the XML.
+        start, end = strip_span(text, start, end)
+        if tag is None:
+            if start < end:
+                append_run(insert_paragraph(sect_pr), text[start:end])
+        elif tag == 'H1':
+            p = insert_paragraph(sect_pr)
+            append_run(p, text[start:end], font_size=params.heading1.font_size, bold=params.heading1.bold)
         elif tag == 'H2':
-            p = document.add_paragraph()
-            run = p.add_run(content)
-            run.font.size = Pt(params.heading2.font_size)
-            run.bold = params.heading2.bold
+            p = insert_paragraph(sect_pr)
+            append_run(p, text[start:end], font_size=params.heading2.font_size, bold=params.heading2.bold)
         elif tag == 'SHLOKA':
-            p = document.add_paragraph()
-            lines = content.split('\n')
-            for i, line in enumerate(lines):
-                if i > 0:
-                    p.add_run().add_break()
-                run = p.add_run(line.strip())
-                run.italic = True
-            p.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+            p = insert_paragraph(sect_pr, alignment='center')
+            line_start = start
+            while True:
+                line_end = text.find('\n', line_start, end)
+                if line_end == -1:
+                    line_end = end
+                if line_start > start:
+                    etree.SubElement(etree.SubElement(p, qn('w:r')), qn('w:br'))
+                append_run(p, text[slice(*strip_span(text, line_start, line_end))], italic=True)
+                if line_end == end:
+                    break
+                line_start = line_end + 1
         elif tag == 'TRANSLATION':
-            p = document.add_paragraph(content)
-            p.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
-        
-        cursor = match.end()
-
-    remaining_text = content_without_markers[cursor:]
-    if remaining_text.strip():
-        cleaned_remaining = re.sub(r'\[/?(ITALIC|CITE:.*?)\]', '', remaining_text)
-        document.add_paragraph(cleaned_remaining.strip())
+            p = insert_paragraph(sect_pr, alignment='left')
+            if start < end:
+                append_run(p, text[start:end])
 
     # --- 3. Add Glossary Section ---
     if params.glossary:
@@ -85,13 +245,20 @@ def create_final_docx(params: FinalDocumentData) -> io.BytesIO:
         table.style = 'Table Grid'
         hdr_cells = table.rows[0].cells
         hdr_cells[0].text, hdr_cells[1].text, hdr_cells[2].text, hdr_cells[3].text = 'Term', 'Transliteration', 'Translation', 'Context/Citation'
+        # Rows are cloned from an empty template row and filled in directly,
+        # avoiding add_row()/cell.text bookkeeping for every glossary entry.
+        tbl = table._tbl
+        row_template = table.add_row()._tr
+        tbl.remove(row_template)
         for item in params.glossary:
-            row_cells = table.add_row().cells
-            row_cells[0].text, row_cells[1].text, row_cells[2].text, row_cells[3].text = item.term, item.transliteration, item.translation, item.context or ''
+            tr = copy.deepcopy(row_template)
+            for p, value in zip(tr.iter(W_P), (item.term, item.transliteration, item.translation, item.context or '')):
+                append_run(p, value)
+            tbl.append(tr)
 
     # --- 4. Save to Memory Buffer ---
     file_stream = io.BytesIO()
-    document.save(file_stream)
+    save_document(document, file_stream, compress=params.compress_output)
     file_stream.seek(0)
     return file_stream
 
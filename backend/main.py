@@ -1,21 +1,196 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+import msgspec
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+import asyncio
 import io
+import logging
+import multiprocessing
+import os
+import queue
+import re
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 
 from models import AnalysisResponse, FinalizeRequest, FinalDocumentData
 from doc_handler import extract_text_from_docx, create_final_docx
-from ai_processor import detect_languages_in_text, finalize_manuscript
+from ai_processor import detect_languages_in_text, finalize_manuscript, open_client, close_client
+
+logger = logging.getLogger(__name__)
+
+# --- Download Offloading ---
+# When DOCX_ACCEL_REDIRECT_DIR is set, finished documents are written there
+# and nginx serves them via X-Accel-Redirect, keeping Python out of the byte
+# path. nginx needs a matching internal location, e.g.:
+#     location /internal/ { internal; alias /var/cache/proofedit/; }
+DOCX_MEDIA_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+DOCX_ACCEL_DIR = os.environ.get("DOCX_ACCEL_REDIRECT_DIR")
+DOCX_ACCEL_LOCATION = os.environ.get("DOCX_ACCEL_REDIRECT_LOCATION", "/internal/")
+DOCX_ACCEL_MAX_AGE_SECONDS = 10 * 60
+DOCX_ACCEL_SWEEP_INTERVAL_SECONDS = 60
+
+def spool_for_accel_redirect(output_stream: io.BytesIO) -> str:
+    """Writes the document into DOCX_ACCEL_DIR under a random name and returns that name."""
+    file_name = f"{uuid.uuid4().hex}.docx"
+    with open(os.path.join(DOCX_ACCEL_DIR, file_name), 'wb') as f:
+        f.write(output_stream.getbuffer())
+    return file_name
+
+def sweep_accel_redirect_dir() -> None:
+    """Removes documents older than DOCX_ACCEL_MAX_AGE_SECONDS from DOCX_ACCEL_DIR."""
+    cutoff = time.time() - DOCX_ACCEL_MAX_AGE_SECONDS
+    with os.scandir(DOCX_ACCEL_DIR) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.docx'):
+                continue
+            # Another worker sweeping the same directory may get there first.
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+async def sweep_accel_redirect_dir_periodically() -> None:
+    """Sweeps DOCX_ACCEL_DIR in the background, off the download request path."""
+    while True:
+        try:
+            await asyncio.to_thread(sweep_accel_redirect_dir)
+        except OSError:
+            logger.exception("Error sweeping the X-Accel-Redirect directory")
+        await asyncio.sleep(DOCX_ACCEL_SWEEP_INTERVAL_SECONDS)
+
+# --- Logging ---
+# Records are handed to a queue and written by a background listener thread,
+# so logging never blocks the event loop on a slow stderr.
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = QueueListener(log_queue, log_handler)
+log_queue_handler = QueueHandler(log_queue)
+# Only this app's loggers are raised to INFO; libraries keep their own levels.
+APP_LOGGER_NAMES = (__name__, "ai_processor")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    root_logger = logging.getLogger()
+    root_logger.addHandler(log_queue_handler)
+    for name in APP_LOGGER_NAMES:
+        logging.getLogger(name).setLevel(logging.INFO)
+    log_listener.start()
+    open_client()
+    # create_final_docx is CPU-bound (XML building and zipping), so it runs in
+    # worker processes to keep the event loop free for concurrent AI requests.
+    # Workers are spawned rather than forked so they don't inherit gRPC state.
+    app.state.docx_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+    accel_sweeper = asyncio.create_task(sweep_accel_redirect_dir_periodically()) if DOCX_ACCEL_DIR else None
+    try:
+        yield
+    finally:
+        if accel_sweeper:
+            accel_sweeper.cancel()
+        try:
+            await close_client()
+        finally:
+            app.state.docx_pool.shutdown(cancel_futures=True)
+            root_logger.removeHandler(log_queue_handler)
+            log_listener.stop()
+
+async def stream_bytesio(buffer: io.BytesIO, chunk_size: int = 64 * 1024):
+    """
+    Yields an in-memory file in fixed-size chunks. Being an async generator,
+    Starlette streams it on the event loop instead of iterating a sync
+    iterator (line by line, for BytesIO) through the threadpool.
+    """
+    buffer.seek(0)
+    while chunk := buffer.read(chunk_size):
+        yield chunk
+
+# --- Uploads ---
+# Starlette already spools each upload to a temporary file that moves to
+# disk past 1 MiB; the handler reads that file directly.
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+DOCX_EXTENSIONS = ('.docx',)
+# Every .docx is a ZIP archive, which starts with a local file header.
+DOCX_SIGNATURE = b"PK\x03\x04"
+
+class UploadSizeLimitMiddleware:
+    """
+    Rejects uploads to `paths` larger than `max_bytes` with a 413 before the
+    body is read: up front from Content-Length, and otherwise as soon as the
+    running count of received body bytes passes the limit. Without this, the
+    whole multipart body would be parsed to disk before the handler runs.
+    """
+    def __init__(self, app: ASGIApp, paths: frozenset, max_bytes: int):
+        self.app = app
+        self.paths = paths
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        # Closing the connection stops the server from draining the rest of the body.
+        too_large = ORJSONResponse({"detail": "The uploaded file is too large."}, status_code=413, headers={"Connection": "close"})
+        content_length = Headers(scope=scope).get("content-length", "")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            await too_large(scope, receive, send)
+            return
+
+        received = 0
+        rejected = False
+
+        async def limited_receive() -> Message:
+            nonlocal received, rejected
+            message = await receive()
+            if message["type"] == "http.request" and not rejected:
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    rejected = True
+                    await too_large(scope, receive, send)
+                    # The app sees a disconnect and stops reading the body.
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message: Message):
+            if not rejected:
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            # Errors from the aborted body read are expected once the 413 is sent.
+            if not rejected:
+                raise
 
 # --- App Initialization ---
-app = FastAPI(title="AI Editor & Publisher API")
+app = FastAPI(title="AI Editor & Publisher API", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Added first so it sits inside CORS and the 413 still carries CORS headers.
+app.add_middleware(UploadSizeLimitMiddleware, paths=frozenset({"/analyze-document/"}), max_bytes=MAX_UPLOAD_BYTES)
+
+# Compresses JSON responses (the finalized manuscript preview can be large).
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# CORS_ORIGINS is a comma-separated allow-list for deployment. Left unset, any
+# origin is allowed for development; the frontend sends no credentials, so
+# Starlette can answer with a fixed "*" instead of echoing each origin.
+CORS_ORIGINS = [origin.strip() for origin in os.environ.get("CORS_ORIGINS", "*").split(",") if origin.strip()]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"], # Allows all origins for development
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=CORS_ORIGINS,
+    allow_credentials="*" not in CORS_ORIGINS,
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type"],
 )
 
 @app.post("/analyze-document/", response_model=AnalysisResponse)
@@ -23,20 +198,23 @@ async def analyze_document_endpoint(file: UploadFile = File(...)):
     """
     Step 1: Analyzes the uploaded document to extract raw text and detect languages.
     """
-    if not file.filename.endswith('.docx'):
+    if not (file.filename or '').lower().endswith(DOCX_EXTENSIONS):
         raise HTTPException(status_code=400, detail="Please upload a .docx file.")
 
+    if await file.read(len(DOCX_SIGNATURE)) != DOCX_SIGNATURE:
+        raise HTTPException(status_code=415, detail="The uploaded file is not a valid .docx document.")
+    await file.seek(0)
+
     try:
-        file_content_stream = io.BytesIO(await file.read())
-        raw_text = extract_text_from_docx(file_content_stream)
+        raw_text = await run_in_threadpool(extract_text_from_docx, file.file)
         detected_languages = await detect_languages_in_text(raw_text)
 
         return AnalysisResponse(raw_text=raw_text, detected_languages=detected_languages)
 
     except (ValueError, RuntimeError) as e:
         raise HTTPException(status_code=500, detail=str(e))
-    except Exception as e:
-        print(f"An unexpected error occurred during analysis: {e}")
+    except Exception:
+        logger.exception("An unexpected error occurred during analysis")
         raise HTTPException(status_code=500, detail="An internal server error occurred.")
 
 
@@ -53,27 +231,82 @@ async def finalize_document_endpoint(request: FinalizeRequest):
             options=request.formatting_options,
             generate_glossary=request.generate_glossary
         )
-        return JSONResponse(content=processed_data)
+        return ORJSONResponse(processed_data)
     except Exception as e:
-        print(f"An unexpected error occurred during finalization: {e}")
+        logger.exception("An unexpected error occurred during finalization")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/download-document/")
-async def download_document_endpoint(request: FinalDocumentData):
+# The download body (whole manuscript plus glossary) is the largest payload;
+# decoding the raw JSON bytes straight into Structs skips the intermediate
+# dict. Non-strict mode keeps pydantic's lax coercions (e.g. "12" -> 12).
+final_document_decoder = msgspec.json.Decoder(FinalDocumentData, strict=False)
+
+# Since FastAPI doesn't parse this body, its schema is published by hand.
+(final_document_schema,), final_document_components = msgspec.json.schema_components(
+    [FinalDocumentData], ref_template="#/components/schemas/{name}"
+)
+
+def openapi_with_download_schemas() -> dict:
+    """Builds the default OpenAPI schema plus the components of the download body."""
+    if app.openapi_schema is None:
+        schema = FastAPI.openapi(app)
+        schema.setdefault("components", {}).setdefault("schemas", {}).update(final_document_components)
+    return app.openapi_schema
+
+app.openapi = openapi_with_download_schemas
+
+# msgspec reports the failing field as a JSON path, e.g. "... - at `$.glossary[0].term`".
+DECODE_ERROR = re.compile(r"(?P<msg>.*?)(?: - at `\$(?P<path>[^`]*)`)?", re.DOTALL)
+DECODE_ERROR_PATH_SEGMENT = re.compile(r"\.([^.\[]+)|\[(\d+)\]")
+MISSING_FIELD = re.compile(r"Object missing required field `([^`]+)`")
+
+def decode_error_details(error: msgspec.DecodeError) -> list[dict]:
+    """Converts a msgspec decode error into FastAPI-style validation error details."""
+    if not isinstance(error, msgspec.ValidationError):
+        return [{"type": "json_invalid", "loc": ("body",), "msg": str(error)}]
+    match = DECODE_ERROR.fullmatch(str(error))
+    loc = ["body"]
+    for key, index in DECODE_ERROR_PATH_SEGMENT.findall(match["path"] or ""):
+        loc.append(key or int(index))
+    error_type = "value_error"
+    if missing_field := MISSING_FIELD.fullmatch(match["msg"]):
+        loc.append(missing_field[1])
+        error_type = "missing"
+    return [{"type": error_type, "loc": tuple(loc), "msg": match["msg"]}]
+
+@app.post(
+    "/download-document/",
+    openapi_extra={"requestBody": {"required": True, "content": {"application/json": {"schema": final_document_schema}}}},
+)
+async def download_document_endpoint(request: Request):
     """
     Step 3: Takes the final, user-approved text and glossary data,
     and generates the final formatted .docx file for download.
     """
     try:
-        output_stream = create_final_docx(request)
-        
+        document_data = final_document_decoder.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise RequestValidationError(decode_error_details(e))
+
+    try:
+        loop = asyncio.get_running_loop()
+        output_stream = await loop.run_in_executor(request.app.state.docx_pool, create_final_docx, document_data)
+        headers = {'Content-Disposition': 'attachment; filename="Formatted_Manuscript.docx"'}
+
+        if DOCX_ACCEL_DIR:
+            file_name = await asyncio.to_thread(spool_for_accel_redirect, output_stream)
+            headers['X-Accel-Redirect'] = f"{DOCX_ACCEL_LOCATION}{file_name}"
+            return Response(media_type=DOCX_MEDIA_TYPE, headers=headers)
+
+        # A .docx is already a ZIP archive; marking it identity-encoded
+        # keeps GZipMiddleware from compressing it a second time.
         return StreamingResponse(
-            output_stream,
-            media_type='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            headers={'Content-Disposition': 'attachment; filename="Formatted_Manuscript.docx"'}
+            stream_bytesio(output_stream),
+            media_type=DOCX_MEDIA_TYPE,
+            headers={**headers, 'Content-Encoding': 'identity'}
         )
-    except Exception as e:
-        print(f"Error creating final docx: {e}")
+    except Exception:
+        logger.exception("Error creating final docx")
         raise HTTPException(status_code=500, detail="Failed to generate the final document.")
 
@@ -1,11 +1,19 @@
-from pydantic import BaseModel, Field
+import msgspec
+from pydantic import BaseModel, ConfigDict
 from typing import List, Optional
 
 # --- New Model for Heading Styles ---
 class HeadingStyle(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     font_size: int = 24
     bold: bool = True
 
+# Shared defaults: frozen models are never copied, so finalize requests that
+# omit a heading style all reference these instead of building new ones.
+HEADING1_DEFAULT = HeadingStyle()
+HEADING2_DEFAULT = HeadingStyle(font_size=18, bold=True)
+
 # --- Stage 1: Analysis ---
 class AnalysisResponse(BaseModel):
     """
@@ -19,6 +27,8 @@ class SanskritShlokaOptions(BaseModel):
     """
     Detailed formatting options specifically for Sanskrit shlokas.
     """
+    model_config = ConfigDict(frozen=True)
+
     center_align: bool = True
     line_breaks: bool = True
     add_numbering: bool = False
@@ -28,12 +38,14 @@ class FormattingOptions(BaseModel):
     """
     A comprehensive model for all user-selected formatting.
     """
+    model_config = ConfigDict(frozen=True)
+
     margins: float = 1.0
     line_spacing: float = 1.5
     font_family: str = "Times New Roman"
     font_size: int = 12
-    heading1: HeadingStyle = Field(default_factory=HeadingStyle)
-    heading2: HeadingStyle = Field(default_factory=lambda: HeadingStyle(font_size=18, bold=True))
+    heading1: HeadingStyle = HEADING1_DEFAULT
+    heading2: HeadingStyle = HEADING2_DEFAULT
     sanskrit_shlokas: Optional[SanskritShlokaOptions] = None
 
 class FinalizeRequest(BaseModel):
@@ -46,13 +58,24 @@ class FinalizeRequest(BaseModel):
     formatting_options: FormattingOptions
 
 # --- Stage 3: Download ---
-class GlossaryItem(BaseModel):
+# The download body carries the whole manuscript and glossary, so these are
+# msgspec Structs, decoded and validated in a single pass over the JSON.
+# HeadingStyle has to be mirrored as a Struct here; its defaults are taken
+# from the pydantic model so the values are only defined once.
+class DocumentHeadingStyle(msgspec.Struct, frozen=True):
+    font_size: int = HEADING1_DEFAULT.font_size
+    bold: bool = HEADING1_DEFAULT.bold
+
+DOCUMENT_HEADING1_DEFAULT = DocumentHeadingStyle()
+DOCUMENT_HEADING2_DEFAULT = DocumentHeadingStyle(font_size=HEADING2_DEFAULT.font_size, bold=HEADING2_DEFAULT.bold)
+
+class GlossaryItem(msgspec.Struct, frozen=True):
     term: str
     transliteration: str
     translation: str
     context: Optional[str] = None
 
-class FinalDocumentData(BaseModel):
+class FinalDocumentData(msgspec.Struct):
     """
     Data required to generate the final .docx file.
     This is sent from the frontend for the download step.
@@ -68,6 +91,8 @@ class FinalDocumentData(BaseModel):
     margin_left: float = 1.0
     margin_right: float = 1.0
     # Heading formatting
-    heading1: HeadingStyle = Field(default_factory=HeadingStyle)
-    heading2: HeadingStyle = Field(default_factory=lambda: HeadingStyle(font_size=18, bold=True))
+    heading1: DocumentHeadingStyle = DOCUMENT_HEADING1_DEFAULT
+    heading2: DocumentHeadingStyle = DOCUMENT_HEADING2_DEFAULT
+    # Output: fast DEFLATE when True, uncompressed (larger file, cheapest save) when False
+    compress_output: bool = True
 
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The backend modules import each other by top-level name, as when run from backend/.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# ai_processor refuses to import without a key; no test talks to Gemini.
+os.environ.setdefault("GOOGLE_API_KEY", "test")
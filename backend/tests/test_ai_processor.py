@@ -0,0 +1,175 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import ai_processor
+from ai_processor import split_into_chunks
+
+class StubModel:
+    """Stands in for genai.GenerativeModel, replying with `replies` in order."""
+    def __init__(self, *replies, delay: float = 0):
+        self.model_name = "models/stub"
+        self.cached_content = None
+        self.replies = list(replies)
+        self.delay = delay
+        self.calls = 0
+
+    async def generate_content_async(self, prompt):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        reply = self.replies.pop(0) if len(self.replies) > 1 else self.replies[0]
+        if isinstance(reply, Exception):
+            raise reply
+        return SimpleNamespace(text=reply)
+
+@pytest.fixture(autouse=True)
+def empty_response_cache():
+    ai_processor.response_cache.clear()
+    yield
+    ai_processor.response_cache.clear()
+
+def test_generate_text_semaphore_survives_a_new_event_loop():
+    model = StubModel("ok", delay=0.01)
+
+    async def contend():
+        # More callers than slots, so some of them wait on the semaphore.
+        prompts = [f"prompt {i}" for i in range(ai_processor.MAX_CONCURRENT_REQUESTS + 2)]
+        return await asyncio.gather(*(ai_processor.generate_text(prompt, model=model) for prompt in prompts))
+
+    assert set(asyncio.run(contend())) == {"ok"}
+    ai_processor.response_cache.clear()
+    assert set(asyncio.run(contend())) == {"ok"}
+
+PARAGRAPH = "The first sentence. A second one!\tThen a third? Done. " * 8
+
+@pytest.mark.parametrize("raw_text", [
+    "",
+    "short text",
+    "\n".join([PARAGRAPH] * 20),
+    PARAGRAPH * 30,
+    "x" * 500 + "\n" + "y" * 50,
+    "x" * 500,
+    "\n\n" + PARAGRAPH + "\n\n\n" + PARAGRAPH + "\n",
+    "श्लोक एक। दूसरा श्लोक॥ " * 40,
+])
+@pytest.mark.parametrize("max_chars", [40, 100, 6000])
+def test_split_into_chunks_round_trips(raw_text, max_chars):
+    chunks = split_into_chunks(raw_text, max_chars)
+    assert ''.join(chunk + separator for chunk, separator in chunks) == raw_text
+    assert chunks[-1][1] == ''
+
+def test_split_into_chunks_respects_max_chars_at_breaks():
+    raw_text = "\n".join([PARAGRAPH] * 20)
+    for chunk, _ in split_into_chunks(raw_text, 1000):
+        assert len(chunk) <= 1000
+
+def test_reset_default_async_client_fails_soft_without_the_private_registry(monkeypatch, caplog):
+    monkeypatch.delattr(ai_processor.genai_client, "_client_manager")
+    ai_processor.reset_default_async_client()
+    assert "Could not reset" in caplog.text
+
+class TokenCountingModel(StubModel):
+    def __init__(self, total_tokens: int):
+        super().__init__("ok")
+        self.total_tokens = total_tokens
+        self.token_counts = 0
+
+    async def count_tokens_async(self, contents):
+        self.token_counts += 1
+        return SimpleNamespace(total_tokens=self.total_tokens)
+
+@pytest.fixture
+def context_caching(monkeypatch):
+    monkeypatch.setattr(ai_processor, "CONTEXT_CACHE_TTL_MINUTES", 5)
+    ai_processor.context_cache_models.clear()
+    yield
+    ai_processor.context_cache_models.clear()
+
+def test_failed_context_cache_creation_is_remembered(context_caching, monkeypatch):
+    creates = []
+
+    def failing_create(**kwargs):
+        creates.append(kwargs)
+        raise ValueError("Cached content is too small.")
+
+    monkeypatch.setattr(ai_processor, "get_model", lambda: TokenCountingModel(5000))
+    monkeypatch.setattr(ai_processor.caching.CachedContent, "create", failing_create)
+    text = "word " * 2000
+
+    async def twice():
+        return [await ai_processor.get_context_cached_model(text) for _ in range(2)]
+
+    assert asyncio.run(twice()) == [None, None]
+    assert len(creates) == 1
+
+def test_context_cache_skips_texts_below_the_token_minimum(context_caching, monkeypatch):
+    model = TokenCountingModel(ai_processor.CONTEXT_CACHE_MIN_TOKENS - 1)
+    monkeypatch.setattr(ai_processor, "get_model", lambda: model)
+    monkeypatch.setattr(ai_processor.caching.CachedContent, "create", pytest.fail)
+    text = "word " * 2000
+
+    async def twice():
+        return [await ai_processor.get_context_cached_model(text) for _ in range(2)]
+
+    assert asyncio.run(twice()) == [None, None]
+    assert model.token_counts == 1
+    assert asyncio.run(ai_processor.get_context_cached_model("too short")) is None
+    assert model.token_counts == 1
+
+def test_generate_text_does_not_cache_a_reply_that_fails_to_parse():
+    model = StubModel("not json at all", '["a", "b"]')
+
+    async def ask():
+        return await ai_processor.generate_text("glossary prompt", model=model, parse=ai_processor.parse_json_response)
+
+    with pytest.raises(ValueError):
+        asyncio.run(ask())
+    assert len(ai_processor.response_cache) == 0
+    assert asyncio.run(ask()) == ["a", "b"]
+    assert asyncio.run(ask()) == ["a", "b"]
+    assert model.calls == 2
+
+def test_language_list_that_is_not_strings_falls_back_without_caching(monkeypatch):
+    model = StubModel('[{"language": "Hindi"}]', '["Hindi", "Sanskrit"]')
+    monkeypatch.setattr(ai_processor, "get_model", lambda: model)
+
+    assert asyncio.run(ai_processor.detect_languages_in_text("धर्म text")) == ["English"]
+    assert len(ai_processor.response_cache) == 0
+    assert asyncio.run(ai_processor.detect_languages_in_text("धर्म text")) == ["Hindi", "Sanskrit"]
+    assert model.calls == 2
+
+def test_generate_text_retries_resource_exhausted(monkeypatch):
+    monkeypatch.setattr(ai_processor, "RETRY_BASE_DELAY_SECONDS", 0)
+    model = StubModel(ai_processor.google_exceptions.ResourceExhausted("quota"), "edited")
+
+    assert asyncio.run(ai_processor.generate_text("editor prompt", model=model)) == "edited"
+    assert model.calls == 2
+
+def test_generate_text_gives_up_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(ai_processor, "RETRY_BASE_DELAY_SECONDS", 0)
+    model = StubModel(ai_processor.google_exceptions.ResourceExhausted("quota"))
+
+    with pytest.raises(ai_processor.google_exceptions.ResourceExhausted):
+        asyncio.run(ai_processor.generate_text("editor prompt", model=model))
+    assert model.calls == ai_processor.MAX_ATTEMPTS
+    assert len(ai_processor.response_cache) == 0
+
+def test_merge_glossaries_dedupes_in_first_appearance_order_and_fills_gaps():
+    merged = ai_processor.merge_glossaries([
+        [
+            {"term": "धर्म", "transliteration": "dharma", "translation": "", "context": None},
+            {"term": "कर्म", "transliteration": "karma", "translation": "action", "context": "Gita 2.47"},
+        ],
+        [
+            "not an entry",
+            {"term": " धर्म ", "transliteration": "dharm", "translation": "duty", "context": "Gita 2.31"},
+            {"term": "योग", "transliteration": "yoga", "translation": "union", "context": None},
+            {"term": "कर्म", "transliteration": "karm", "translation": "deed", "context": "Gita 3.8"},
+        ],
+    ])
+    assert merged == [
+        {"term": "धर्म", "transliteration": "dharma", "translation": "duty", "context": "Gita 2.31"},
+        {"term": "कर्म", "transliteration": "karma", "translation": "action", "context": "Gita 2.47"},
+        {"term": "योग", "transliteration": "yoga", "translation": "union", "context": None},
+    ]
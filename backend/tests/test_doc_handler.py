@@ -0,0 +1,162 @@
+import io
+import re
+from zipfile import ZipFile
+
+import msgspec
+import pytest
+from docx import Document
+from docx.enum.text import WD_BREAK, WD_PARAGRAPH_ALIGNMENT
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+from docx.shared import Inches, Pt
+
+from doc_handler import create_final_docx, extract_text_from_docx
+from models import FinalDocumentData
+
+def reference_docx(params: FinalDocumentData) -> io.BytesIO:
+    """The python-docx implementation create_final_docx must stay byte-compatible with."""
+    document = Document()
+    style = document.styles['Normal']
+    style.font.name = params.font_family
+    style.font.size = Pt(params.font_size)
+    style.paragraph_format.line_spacing = params.line_spacing
+    for section in document.sections:
+        section.top_margin = Inches(params.margin_top)
+        section.bottom_margin = Inches(params.margin_bottom)
+        section.left_margin = Inches(params.margin_left)
+        section.right_margin = Inches(params.margin_right)
+
+    text = params.edited_manuscript
+    cursor = 0
+    for match in re.finditer(r'(\[(H1|H2|SHLOKA|TRANSLATION)\].*?\[/\2\])', text, re.DOTALL):
+        plain_text = text[cursor:match.start()]
+        if plain_text.strip():
+            document.add_paragraph(plain_text.strip())
+        tag = match.group(2)
+        content = match.group(1)[len(tag)+2:-len(tag)-3].strip()
+        if tag in ('H1', 'H2'):
+            heading = params.heading1 if tag == 'H1' else params.heading2
+            run = document.add_paragraph().add_run(content)
+            run.font.size = Pt(heading.font_size)
+            run.bold = heading.bold
+        elif tag == 'SHLOKA':
+            p = document.add_paragraph()
+            for i, line in enumerate(content.split('\n')):
+                if i > 0:
+                    p.add_run().add_break()
+                p.add_run(line.strip()).italic = True
+            p.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+        else:
+            document.add_paragraph(content).alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
+        cursor = match.end()
+
+    remaining_text = text[cursor:]
+    if remaining_text.strip():
+        document.add_paragraph(re.sub(r'\[/?(ITALIC|CITE:.*?)\]', '', remaining_text).strip())
+
+    if params.glossary:
+        document.add_page_break()
+        document.add_heading('Glossary', level=1)
+        table = document.add_table(rows=1, cols=4)
+        table.style = 'Table Grid'
+        for cell, heading in zip(table.rows[0].cells, ('Term', 'Transliteration', 'Translation', 'Context/Citation')):
+            cell.text = heading
+        for item in params.glossary:
+            for cell, value in zip(table.add_row().cells, (item.term, item.transliteration, item.translation, item.context or '')):
+                cell.text = value
+
+    file_stream = io.BytesIO()
+    document.save(file_stream)
+    file_stream.seek(0)
+    return file_stream
+
+def document_xml(docx_stream: io.BytesIO) -> str:
+    """The main document part with python-docx's random revision ids removed."""
+    xml = ZipFile(docx_stream).read('word/document.xml').decode()
+    return re.sub(r'w:rsid\w*="[^"]*"', '', xml)
+
+def final_document(edited_manuscript: str, **fields) -> FinalDocumentData:
+    return msgspec.convert({'edited_manuscript': edited_manuscript, 'glossary': [], **fields}, FinalDocumentData)
+
+@pytest.mark.parametrize("edited_manuscript", [
+    "",
+    "   \n  ",
+    "Plain text only.",
+    "[H1]Title[/H1]\nBody text.\n[H2]Section[/H2]\nMore text.",
+    "[H1]Unclosed heading\nBody text.",
+    "Text [H2]Unclosed[/H1] and [/H2] a stray close.",
+    "[SHLOKA]Unclosed shloka\nsecond line",
+    "Intro\n[SHLOKA]  first line  \nsecond line\n\n  third line [/SHLOKA]\nAfter.",
+    "[SHLOKA]\n[/SHLOKA]",
+    "[SHLOKA]one line[/SHLOKA][TRANSLATION]  its translation \n[/TRANSLATION]",
+    "Body text [CITE: Gita 2.47]",
+    "Body [ITALIC]text[/ITALIC] ends [ITALIC]",
+    "[H1]Title[/H1] trailing [CITE: source] and [/ITALIC]",
+    "[ITALIC]inside a block[/ITALIC] stays [H2]as [CITE: x] is[/H2] tail [CITE: y",
+    "[TRANSLATION]tab\tand\rcarriage return[/TRANSLATION]",
+    "[[H1]]Nested [brackets][/H1]]",
+    "धर्मक्षेत्रे कुरुक्षेत्रे [SHLOKA]समवेता युयुत्सवः\nमामकाः पाण्डवाश्चैव[/SHLOKA]",
+])
+def test_create_final_docx_matches_reference(edited_manuscript):
+    params = final_document(edited_manuscript)
+    assert document_xml(create_final_docx(params)) == document_xml(reference_docx(params))
+
+def test_create_final_docx_matches_reference_with_glossary_and_formatting():
+    params = final_document(
+        "[H1]Title[/H1]\nBody [CITE: Gita 2.47]",
+        glossary=[
+            {'term': 'धर्म', 'transliteration': 'dharma', 'translation': 'duty', 'context': 'Gita 2.47'},
+            {'term': 'कर्म', 'transliteration': 'karma', 'translation': 'action'},
+        ],
+        font_family='Georgia',
+        font_size=13,
+        line_spacing=1.5,
+        margin_left=1.25,
+        heading1={'font_size': 20, 'bold': False},
+    )
+    assert document_xml(create_final_docx(params)) == document_xml(reference_docx(params))
+
+@pytest.mark.parametrize("compress_output", [True, False])
+def test_create_final_docx_opens_in_python_docx(compress_output):
+    params = final_document("[H1]Title[/H1]\nBody.", compress_output=compress_output)
+    document = Document(create_final_docx(params))
+    assert [p.text for p in document.paragraphs] == ['Title', 'Body.']
+
+def docx_bytes(document) -> io.BytesIO:
+    file_stream = io.BytesIO()
+    document.save(file_stream)
+    file_stream.seek(0)
+    return file_stream
+
+def test_extract_text_matches_python_docx_paragraphs():
+    document = Document()
+    document.add_paragraph("Plain paragraph")
+    document.add_paragraph("Tab\tseparated\tcolumns")
+    p = document.add_paragraph("Line one")
+    p.add_run().add_break()
+    p.add_run("line two")
+    p.add_run().add_break(WD_BREAK.PAGE)
+    p.add_run("after a page break")
+    p = document.add_paragraph("See ")
+    p._p.append(parse_xml(
+        f'<w:hyperlink {nsdecls("w", "r")} r:id="rId99">'
+        '<w:r><w:t xml:space="preserve">the </w:t></w:r><w:r><w:tab/><w:t>link</w:t></w:r>'
+        '</w:hyperlink>'
+    ))
+    p.add_run(" for details.")
+    document.add_paragraph("")
+    document.add_table(rows=1, cols=1).cell(0, 0).text = "Table text is not body text"
+    document.add_paragraph("धर्म")
+
+    expected = '\n'.join(p.text for p in Document(docx_bytes(document)).paragraphs)
+    assert 'the \tlink' in expected
+    assert extract_text_from_docx(docx_bytes(document)) == expected
+
+def test_extract_text_round_trips_generated_document():
+    params = final_document("Intro\n[SHLOKA]first line\nsecond line[/SHLOKA]\n[TRANSLATION]Meaning[/TRANSLATION]")
+    expected = '\n'.join(p.text for p in Document(create_final_docx(params)).paragraphs)
+    assert extract_text_from_docx(create_final_docx(params)) == expected
+
+def test_extract_text_rejects_non_docx():
+    with pytest.raises(ValueError, match="Could not read the docx file"):
+        extract_text_from_docx(io.BytesIO(b"PK\x03\x04 not really a zip"))
@@ -0,0 +1,161 @@
+import asyncio
+import contextlib
+import io
+import logging
+import os
+
+import httpx
+import pytest
+from docx import Document
+from fastapi.testclient import TestClient
+
+import main
+
+def test_sweep_accel_redirect_dir_removes_old_documents_only(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DOCX_ACCEL_DIR", str(tmp_path))
+    old, fresh, other = tmp_path / "old.docx", tmp_path / "fresh.docx", tmp_path / "old.txt"
+    for path in (old, fresh, other):
+        path.write_bytes(b"")
+    os.utime(old, (0, 0))
+    os.utime(other, (0, 0))
+
+    main.sweep_accel_redirect_dir()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["fresh.docx", "old.txt"]
+
+def test_sweep_accel_redirect_dir_skips_documents_removed_concurrently(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DOCX_ACCEL_DIR", str(tmp_path))
+    for name in ("gone.docx", "old.docx"):
+        (tmp_path / name).write_bytes(b"")
+        os.utime(tmp_path / name, (0, 0))
+    real_scandir = os.scandir
+
+    def racing_scandir(path):
+        # Another sweeper removes a document after this one has listed it.
+        with real_scandir(path) as entries:
+            listed = list(entries)
+        (tmp_path / "gone.docx").unlink()
+        return contextlib.nullcontext(listed)
+
+    monkeypatch.setattr(main.os, "scandir", racing_scandir)
+    main.sweep_accel_redirect_dir()
+    assert list(tmp_path.iterdir()) == []
+
+def test_lifespan_cleans_up_when_close_client_fails(monkeypatch):
+    async def failing_close_client():
+        raise RuntimeError("transport already closed")
+
+    monkeypatch.setattr(main, "close_client", failing_close_client)
+    with pytest.raises(RuntimeError, match="transport already closed"):
+        with TestClient(main.app):
+            pool = main.app.state.docx_pool
+    assert pool._shutdown_thread
+    assert main.log_queue_handler not in logging.getLogger().handlers
+    assert main.log_listener._thread is None
+
+def test_lifespan_leaves_the_root_log_level_alone():
+    root_level = logging.getLogger().level
+    with TestClient(main.app):
+        assert logging.getLogger().level == root_level
+        assert logging.getLogger("ai_processor").isEnabledFor(logging.INFO)
+        assert logging.getLogger(main.__name__).isEnabledFor(logging.INFO)
+    assert logging.getLogger().level == root_level
+
+@pytest.fixture
+def no_language_detection(monkeypatch):
+    async def detect_languages_in_text(raw_text):
+        return ["English"]
+
+    monkeypatch.setattr(main, "detect_languages_in_text", detect_languages_in_text)
+
+def docx_upload(*paragraphs: str) -> bytes:
+    document = Document()
+    for text in paragraphs:
+        document.add_paragraph(text)
+    file_stream = io.BytesIO()
+    document.save(file_stream)
+    return file_stream.getvalue()
+
+def limited_app(max_bytes: int) -> main.UploadSizeLimitMiddleware:
+    return main.UploadSizeLimitMiddleware(main.app, paths=frozenset({"/analyze-document/"}), max_bytes=max_bytes)
+
+def upload_files(data: bytes, filename: str = "manuscript.docx") -> dict:
+    return {"file": (filename, data, main.DOCX_MEDIA_TYPE)}
+
+def call_with_chunked_body(app, data: bytes, chunk_size: int):
+    """
+    Posts `data` as a multipart upload with no Content-Length, delivered in
+    `chunk_size` pieces. Returns the messages sent back and the number of
+    body messages the app never asked for.
+    """
+    request = httpx.Request("POST", "http://testserver/analyze-document/", files=upload_files(data))
+    body = request.read()
+    pending = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+    headers = [(b"content-type", request.headers["content-type"].encode())]
+    sent = []
+
+    async def receive():
+        if pending:
+            chunk = pending.pop(0)
+            return {"type": "http.request", "body": chunk, "more_body": bool(pending)}
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/analyze-document/", "raw_path": b"/analyze-document/",
+        "root_path": "", "query_string": b"", "headers": headers,
+        "client": ("testclient", 50000), "server": ("testserver", 80),
+    }
+    asyncio.run(app(scope, receive, send))
+    return sent, len(pending)
+
+def test_upload_over_the_limit_is_rejected_from_content_length():
+    response = TestClient(limited_app(1024)).post("/analyze-document/", files=upload_files(docx_upload("text")))
+    assert response.status_code == 413
+    assert response.json() == {"detail": "The uploaded file is too large."}
+    assert response.headers["connection"] == "close"
+
+def test_chunked_upload_over_the_limit_is_rejected_mid_stream():
+    sent, unread_chunks = call_with_chunked_body(limited_app(8 * 1024), docx_upload("text"), chunk_size=1024)
+    starts = [message for message in sent if message["type"] == "http.response.start"]
+    assert [start["status"] for start in starts] == [413]
+    assert b'"The uploaded file is too large."' in b"".join(message.get("body", b"") for message in sent)
+    assert unread_chunks > 0
+
+def test_chunked_upload_under_the_limit_passes_through(no_language_detection):
+    sent, unread_chunks = call_with_chunked_body(limited_app(1024 * 1024), docx_upload("First", "Second"), chunk_size=1024)
+    assert [message["status"] for message in sent if message["type"] == "http.response.start"] == [200]
+    assert b'"raw_text":"First\\nSecond"' in b"".join(message.get("body", b"") for message in sent)
+    assert unread_chunks == 0
+
+def test_upload_under_the_limit_passes_through(no_language_detection):
+    response = TestClient(limited_app(1024 * 1024)).post("/analyze-document/", files=upload_files(docx_upload("First", "Second")))
+    assert response.status_code == 200
+    assert response.json() == {"raw_text": "First\nSecond", "detected_languages": ["English"]}
+
+def test_upload_that_is_not_a_zip_archive_is_rejected():
+    response = TestClient(main.app).post("/analyze-document/", files=upload_files(b"Plain text renamed to .docx"))
+    assert response.status_code == 415
+    assert response.json() == {"detail": "The uploaded file is not a valid .docx document."}
+
+@pytest.mark.parametrize("body, loc, error_type", [
+    (
+        b'{"edited_manuscript": "x", "glossary": [{"term": 1, "transliteration": "a", "translation": "b"}]}',
+        ["body", "glossary", 0, "term"], "value_error",
+    ),
+    (b'{"glossary": []}', ["body", "edited_manuscript"], "missing"),
+    (
+        b'{"edited_manuscript": "x", "glossary": [{"term": "a"}, {"term": "b", "transliteration": "c"}]}',
+        ["body", "glossary", 0, "transliteration"], "missing",
+    ),
+    (b'{"edited_manuscript": ', ["body"], "json_invalid"),
+    (b'{"edited_manuscript": "x", "glossary": []} trailing', ["body"], "json_invalid"),
+])
+def test_download_validation_errors_point_at_the_field(body, loc, error_type):
+    response = TestClient(main.app).post("/download-document/", content=body, headers={"content-type": "application/json"})
+    assert response.status_code == 422
+    [detail] = response.json()["detail"]
+    assert (detail["loc"], detail["type"]) == (loc, error_type)
+    assert detail["msg"]